@@ -1,14 +1,26 @@
 # main.py (root of the repo)
 from __future__ import annotations
+import asyncio
+import functools
+import hashlib
+import hmac
+import ipaddress
 import os
+import re
+import socket
+import threading
+import time
 import uuid
-import mimetypes
+from collections import OrderedDict
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
 
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from yt_dlp import YoutubeDL
 
 # --- Load .env early (expects .env next to this file) ---
@@ -32,11 +44,65 @@ B2_S3_ENDPOINT     = os.getenv("B2_S3_ENDPOINT", "https://s3.us-west-002.backbla
 B2_PUBLIC_READ     = _env_bool("B2_PUBLIC_READ", "true")
 B2_PUBLIC_BASE_URL = os.getenv("B2_PUBLIC_BASE_URL")  # optional CDN/website domain for public buckets
 B2_PRESIGNED_TTL   = int(os.getenv("B2_PRESIGNED_TTL", "604800"))  # 7 days default
+B2_PUBLIC_BASE     = B2_PUBLIC_BASE_URL or f"{B2_S3_ENDPOINT}/{B2_BUCKET_NAME}"
+_B2_ENDPOINT       = urlsplit(B2_S3_ENDPOINT)
+
+def _b2_region(endpoint: str) -> Optional[str]:
+    """Signing region from an s3.<region>.backblazeb2.com endpoint, else None."""
+    m = re.match(r"https?://s3\.([a-z0-9-]+)\.backblazeb2\.com/?$", endpoint)
+    return m.group(1) if m else None
+
+B2_REGION          = os.getenv("B2_REGION") or _b2_region(B2_S3_ENDPOINT)
+
+# --- B2 multipart tuning (parallel part uploads over high-RTT links) ---
+B2_MULTIPART_THRESHOLD_MB = int(os.getenv("B2_MULTIPART_THRESHOLD_MB", "8"))  # smaller files: single PutObject
+_B2_MULTIPART_THRESHOLD   = B2_MULTIPART_THRESHOLD_MB * 1024 * 1024
+B2_MULTIPART_CHUNK_MB     = int(os.getenv("B2_MULTIPART_CHUNK_MB", "16"))
+B2_MULTIPART_CONCURRENCY  = int(os.getenv("B2_MULTIPART_CONCURRENCY", "10"))
+# Keep-alive sockets to B2; should cover concurrency x concurrent uploads (YDL_POOL_SIZE)
+B2_MAX_POOL_CONNECTIONS   = int(os.getenv("B2_MAX_POOL_CONNECTIONS", "50"))
+
+# --- Request URL validation (cheap reject before yt-dlp runs its extractor matching) ---
+# Shape check for an http(s) URL with no whitespace/quotes. The host to vet is
+# taken from urlsplit, which splits userinfo on the last "@" as HTTP clients do
+# (in http://a@b@127.0.0.1/ the host is 127.0.0.1, not "b@127.0.0.1").
+_URL_RE = re.compile(
+    r"""^https?://(?:[^\s/?#@<>"']*@)?(\[[^\]\s]+\]|[^\s/?#:<>"']+)(?::\d+)?(?:[/?#][^\s<>"']*)?$""",
+    re.IGNORECASE,
+)
+# Literal IP hosts in any spelling (127.1, 2130706433, 0x7f000001, [::ffff:127.0.0.1])
+# are rejected unless globally routable. Names are only checked against this
+# denylist, not resolved: a DNS name pointing at a private address still passes,
+# so this is a cheap first filter, not complete SSRF protection.
+# BLOCKED_HOSTS adds more names (comma-separated).
+_BLOCKED_HOSTS = frozenset(
+    h.strip().lower().rstrip(".")
+    for h in ("localhost,metadata.google.internal," + os.getenv("BLOCKED_HOSTS", "")).split(",")
+    if h.strip()
+)
+
+# yt-dlp's YouTube bot-check message; \S* covers both ' and ’ apostrophes
+_BOT_RE = re.compile(r"(?i)confirm\s+you\S*\s+not\s+a\s+bot")
+
+# --- Serve DOWNLOAD_DIR from FastAPI; disable when Caddy serves it from a shared volume ---
+SERVE_DOWNLOADS = _env_bool("SERVE_DOWNLOADS", "true")
+
+# --- /api/batch limits ---
+BATCH_MAX_URLS    = int(os.getenv("BATCH_MAX_URLS", "25"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))  # pipelines in flight per batch request
+
+# --- Worker threads for blocking yt-dlp / upload calls (anyio default is 40) ---
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
 
 # --- yt-dlp cookies (optional, to bypass YouTube bot checks) ---
 COOKIES_FROM_BROWSER = os.getenv("COOKIES_FROM_BROWSER")  # e.g. "chrome", "chrome:Default", "firefox:default"
 COOKIES_FILE         = os.getenv("COOKIES_FILE")          # absolute path to cookies.txt
 
+# --- yt-dlp download concurrency (parallel fragments / HTTP range requests) ---
+YDL_CONCURRENT_FRAGMENTS = int(os.getenv("YDL_CONCURRENT_FRAGMENTS", "8"))
+YDL_HTTP_CHUNK_MB        = int(os.getenv("YDL_HTTP_CHUNK_MB", "10"))
+YDL_POOL_SIZE            = int(os.getenv("YDL_POOL_SIZE", "4"))  # reusable YoutubeDL instances
+
 # --- Validate B2 env if enabled; set up client lazily ---
 _b2_client = None
 def _require_b2():
@@ -58,63 +124,206 @@ def _b2():
         _b2_client = boto3.client(
             "s3",
             endpoint_url=B2_S3_ENDPOINT,
+            # Same credential scope as the local presigner (_b2_presigned_url)
+            region_name=B2_REGION,
             aws_access_key_id=B2_KEY_ID,
             aws_secret_access_key=B2_APPLICATION_KEY,
-            config=Config(signature_version="s3v4"),
+            config=Config(
+                signature_version="s3v4",
+                max_pool_connections=B2_MAX_POOL_CONNECTIONS,
+                retries={"mode": "adaptive", "max_attempts": 5},
+                tcp_keepalive=True,
+            ),
         )
     return _b2_client
 
-def _b2_upload_and_url(local_path: Path) -> str:
-    """Upload file to B2 and return a public or presigned URL."""
+def _b2_warm() -> None:
+    """Issue a cheap HeadBucket so the client's connection pool holds a live connection."""
+    from botocore.exceptions import BotoCoreError, ClientError
+    try:
+        _b2().head_bucket(Bucket=B2_BUCKET_NAME)
+    except (BotoCoreError, ClientError):
+        # Warm-up only; a restricted key or an unreachable endpoint is not an error
+        pass
+
+_b2_transfer_config = None
+def _b2_transfer():
+    """Create (or reuse) the multipart TransferConfig used for B2 uploads."""
+    global _b2_transfer_config
+    if _b2_transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        _b2_transfer_config = TransferConfig(
+            multipart_threshold=_B2_MULTIPART_THRESHOLD,
+            multipart_chunksize=B2_MULTIPART_CHUNK_MB * 1024 * 1024,
+            max_concurrency=B2_MULTIPART_CONCURRENCY,
+            use_threads=True,
+        )
+    return _b2_transfer_config
+
+# Outputs are mp4 (merge_output_format) or a single-stream fallback, so a fixed
+# table covers every extension we produce
+_CONTENT_TYPES = {
+    ".mp4": "video/mp4",
+    ".m4a": "audio/mp4",
+    ".webm": "video/webm",
+    ".mkv": "video/x-matroska",
+    ".mp3": "audio/mpeg",
+}
+
+def _b2_upload(local_path: Path) -> str:
+    """Upload a file to B2 under uploads/<name> and return its object key.
+
+    The file name must already be unique (staged downloads carry a per-request prefix).
+    """
     client = _b2()
-    object_key = f"uploads/{uuid.uuid4().hex}-{local_path.name}"
-    content_type, _ = mimetypes.guess_type(local_path.name)
+    object_key = f"uploads/{local_path.name}"
+    content_type = _CONTENT_TYPES.get(local_path.suffix.lower())
     extra = {"ContentType": content_type} if content_type else {}
 
-    # Simple and reliable upload call
-    with open(local_path, "rb") as fh:
-        client.put_object(Bucket=B2_BUCKET_NAME, Key=object_key, Body=fh, **extra)
+    if local_path.stat().st_size < _B2_MULTIPART_THRESHOLD:
+        # Small files (audio-only, short clips): one PutObject, no multipart
+        # create/complete round-trips and no transfer thread pool.
+        # http.client sends file bodies in 8 KB reads; a large buffer turns
+        # those into memory copies instead of one syscall each
+        with open(local_path, "rb", buffering=4 * 1024 * 1024) as fh:
+            client.put_object(Bucket=B2_BUCKET_NAME, Key=object_key, Body=fh, **extra)
+    else:
+        # Multipart upload: worker threads read their own parts from disk, upload
+        # them in parallel and retry individually (no per-part buffering in memory)
+        client.upload_file(
+            str(local_path), B2_BUCKET_NAME, object_key,
+            ExtraArgs=extra, Config=_b2_transfer(),
+        )
+    return object_key
 
+def _b2_object_url(object_key: str) -> str:
+    """Return a public or presigned URL for an uploaded object."""
     if B2_PUBLIC_READ:
-        base = B2_PUBLIC_BASE_URL or f"{B2_S3_ENDPOINT}/{B2_BUCKET_NAME}"
-        return f"{base}/{object_key}"
+        return f"{B2_PUBLIC_BASE}/{object_key}"
+
+    return _b2_presigned_url(object_key, B2_PRESIGNED_TTL)
+
+# --- Presigned GET URLs (SigV4 query auth) ---
+# Signing a GET for a known bucket/endpoint is a handful of HMACs; doing it
+# here skips botocore's generic request-signer pipeline. The derived signing
+# key only depends on the date, so it is cached and rotated daily.
+_sigv4_key_cache: tuple = ("", b"")
+
+def _hmac_sha256(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
 
-    return client.generate_presigned_url(
-        "get_object",
-        Params={"Bucket": B2_BUCKET_NAME, "Key": object_key},
-        ExpiresIn=B2_PRESIGNED_TTL,
+def _sigv4_signing_key(datestamp: str) -> bytes:
+    global _sigv4_key_cache
+    cached_date, key = _sigv4_key_cache
+    if cached_date != datestamp:
+        key = _hmac_sha256(("AWS4" + B2_APPLICATION_KEY).encode("utf-8"), datestamp)
+        for part in (B2_REGION, "s3", "aws4_request"):
+            key = _hmac_sha256(key, part)
+        _sigv4_key_cache = (datestamp, key)
+    return key
+
+def _b2_presigned_url(object_key: str, expires_in: int) -> str:
+    """Return a presigned GET URL for object_key, valid for expires_in seconds."""
+    if not B2_REGION:
+        # Unknown endpoint shape (custom/edge domain): let botocore resolve it
+        return _b2().generate_presigned_url(
+            "get_object",
+            Params={"Bucket": B2_BUCKET_NAME, "Key": object_key},
+            ExpiresIn=expires_in,
+        )
+
+    amz_date = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    datestamp = amz_date[:8]
+    scope = f"{datestamp}/{B2_REGION}/s3/aws4_request"
+    path = f"/{quote(B2_BUCKET_NAME, safe='')}/{quote(object_key, safe='/')}"
+    # Parameters are already in sorted order, as the canonical request requires
+    query = (
+        "X-Amz-Algorithm=AWS4-HMAC-SHA256"
+        f"&X-Amz-Credential={quote(f'{B2_KEY_ID}/{scope}', safe='')}"
+        f"&X-Amz-Date={amz_date}"
+        f"&X-Amz-Expires={expires_in}"
+        "&X-Amz-SignedHeaders=host"
+    )
+    canonical_request = f"GET\n{path}\n{query}\nhost:{_B2_ENDPOINT.netloc}\n\nhost\nUNSIGNED-PAYLOAD"
+    string_to_sign = (
+        f"AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n"
+        + hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
     )
+    signature = hmac.new(
+        _sigv4_signing_key(datestamp), string_to_sign.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+    return f"{_B2_ENDPOINT.scheme}://{_B2_ENDPOINT.netloc}{path}?{query}&X-Amz-Signature={signature}"
 
 # --- FastAPI app ---
 app = FastAPI(
     title="AnyGrab API",
     description="Backend for AnyGrab (anygrab.xyz)",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
-# Expose local downloads via API path (Caddy proxies /api/* to us)
-app.mount("/api/downloads", StaticFiles(directory=DOWNLOAD_DIR), name="downloads")
+# Expose local downloads via API path (Caddy proxies /api/* to us). In the
+# compose stack Caddy serves /api/downloads/* itself, so bytes skip Python.
+if SERVE_DOWNLOADS:
+    app.mount("/api/downloads", StaticFiles(directory=DOWNLOAD_DIR), name="downloads")
 
 @app.on_event("startup")
 async def _startup():
     # Fail fast if B2 is enabled but incomplete
     _require_b2()
+    if B2_ENABLED:
+        # Build the shared client up front: boto3 loads its service models on
+        # first use, and upload threads would otherwise race to create it
+        await run_in_threadpool(_b2)
+        _b2_transfer()
+        # Open a keep-alive TLS connection so the first upload skips the handshake.
+        # Not awaited: with retries an unreachable endpoint can take minutes, and
+        # a daemon thread (unlike the default executor) doesn't hold up shutdown.
+        threading.Thread(target=_b2_warm, name="b2-warm", daemon=True).start()
+    # Blocking yt-dlp/B2 work runs in anyio's threadpool; size it for expected concurrency
+    import anyio.to_thread
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Pay extractor/cookie/plugin init once instead of per request
+    for ydl in await run_in_threadpool(_ydl_pool_build):
+        _ydl_pool.put_nowait(ydl)
+
+@app.on_event("shutdown")
+async def _shutdown():
+    _ydl_pool_close()
 
 @app.get("/api/health")
 def health():
     return {"status": "ok", "app": "AnyGrab", "b2_enabled": B2_ENABLED}
 
+# Output filename; each request prefixes it with its own token (see _process)
+_OUTTMPL_NAME = "%(title).60s-%(id)s.%(ext)s"
+
+@functools.lru_cache(maxsize=1)
 def _ydl_opts() -> Dict[str, Any]:
-    """Build yt-dlp options with optional cookie settings from .env."""
+    """Build yt-dlp options with optional cookie settings from .env.
+
+    Inputs are fixed at import, so the dict is built once; copy it before
+    mutating (YoutubeDL keeps and modifies the params dict it is given).
+    """
     opts: Dict[str, Any] = {
-        "outtmpl": str(DOWNLOAD_DIR / "%(title).60s-%(id)s.%(ext)s"),
+        "outtmpl": str(DOWNLOAD_DIR / _OUTTMPL_NAME),
         "noplaylist": True,
         "quiet": True,
         "no_warnings": True,
         "restrictfilenames": True,
         "merge_output_format": "mp4",
-        "format": "bv*+ba/b",  # best video+audio; fallback to best
-        "postprocessors": [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}],
+        # Prefer native mp4/m4a streams so ffmpeg only stream-copies on merge,
+        # never transcodes; fall back to the best single file of any type
+        "format": "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]/bv*+ba/b",
+        # No faststart args needed: yt-dlp already adds -movflags +faststart to
+        # every ffmpeg output, so merged mp4s can play before fully downloaded
+        # Parallel HLS/DASH fragments and chunked range requests; applied per stream for bv*+ba
+        "concurrent_fragment_downloads": YDL_CONCURRENT_FRAGMENTS,
+        "http_chunk_size": YDL_HTTP_CHUNK_MB * 1024 * 1024,
+        # Let each parallel fetch recover on its own
+        "retries": 5,
+        "fragment_retries": 10,
+        "file_access_retries": 3,
     }
 
     # Optional cookie sources to bypass YouTube "bot" checks
@@ -140,64 +349,208 @@ def _extract_output_path(info: Dict[str, Any]) -> Optional[Path]:
         p = None
     return Path(p) if p else None
 
+# --- Pool of long-lived YoutubeDL instances ---
+# A YoutubeDL instance is not safe to share between threads, so each request
+# checks one out for the duration of extract_info and returns it afterwards.
+# Checkout happens on the event loop: requests waiting for an instance must
+# not sit on a worker thread that other endpoints need.
+# Instances are never used as context managers: __exit__ would tear down the
+# cookie jar and HTTP handlers we want to keep warm.
+_ydl_pool: "asyncio.Queue[YoutubeDL]" = asyncio.Queue()
+
+def _ydl_pool_build() -> List[YoutubeDL]:
+    return [YoutubeDL(dict(_ydl_opts())) for _ in range(YDL_POOL_SIZE)]
+
+def _ydl_pool_close() -> None:
+    while not _ydl_pool.empty():
+        _ydl_pool.get_nowait().close()
+
+async def _extract(url: str, outtmpl: str) -> Dict[str, Any]:
+    """Run yt-dlp on a pooled instance; only the download itself uses a worker thread."""
+    ydl = await _ydl_pool.get()
+    try:
+        # The instance is ours until it goes back to the pool; YoutubeDL reads
+        # the template from params on every prepare_filename call
+        ydl.params["outtmpl"]["default"] = outtmpl
+        # run_in_threadpool isn't cancellable, so the instance is never
+        # returned while its thread is still using it
+        return await run_in_threadpool(ydl.extract_info, url, True)
+    finally:
+        _ydl_pool.put_nowait(ydl)
+
+def _normalize_url(url: Any) -> str:
+    """Strip and sanity-check a request URL; raise 400 for anything yt-dlp shouldn't see."""
+    m = _URL_RE.match(url.strip()) if isinstance(url, str) else None
+    host = urlsplit(m.group(0)).hostname if m else None
+    if not host:
+        raise HTTPException(status_code=400, detail="'url' must be an http(s) URL.")
+    if _host_blocked(host):
+        raise HTTPException(status_code=400, detail="This host is not allowed.")
+    return m.group(0)
+
+def _host_blocked(host: str) -> bool:
+    """True for denylisted names and for literal IPs that aren't globally routable."""
+    host = host.lower().rstrip(".")
+    if host in _BLOCKED_HOSTS or host.endswith(".localhost"):
+        return True
+    try:
+        ip = ipaddress.ip_address(host.strip("[]").replace("%25", "%"))
+    except ValueError:
+        try:
+            # inet_aton also accepts the legacy IPv4 forms HTTP clients honour
+            ip = ipaddress.IPv4Address(socket.inet_aton(host))
+        except OSError:
+            return False  # a DNS name
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return not ip.is_global or ip.is_multicast
+
 def _local_download_url(local_file: Path) -> str:
     """Return the proxied URL for local files (Caddy → /api/*)."""
     return f"/api/downloads/{local_file.name}"
 
-def _maybe_upload(local_file: Path) -> str:
-    """Upload to B2 if enabled, else return local proxied URL."""
+def _maybe_upload(local_file: Path) -> Optional[str]:
+    """Upload to B2 if enabled and return the object key; None when B2 is off."""
     if B2_ENABLED:
-        return _b2_upload_and_url(local_file)
-    return _local_download_url(local_file)
+        return _b2_upload(local_file)
+    return None
+
+# --- Recent results: source URL -> (response without "url", location, expiry) ---
+# The location is the B2 object key, or the file name in DOWNLOAD_DIR when B2
+# is off. Repeat requests for the same video (retries, shared links) reuse it
+# and only get a fresh URL. Only touched from the event loop thread.
+URL_CACHE_SIZE = int(os.getenv("URL_CACHE_SIZE", "256"))
+_URL_CACHE_TTL = min(B2_PRESIGNED_TTL, 86400)
+_url_cache: "OrderedDict[str, Tuple[Dict[str, Any], str, float]]" = OrderedDict()
+_inflight: "Dict[str, asyncio.Task]" = {}
+
+def _url_cache_get(url: str) -> Optional[Dict[str, Any]]:
+    hit = _url_cache.get(url)
+    if not hit:
+        return None
+    meta, location, expires_at = hit
+    if meta["source"] == "local" and not (DOWNLOAD_DIR / location).exists():
+        expires_at = 0  # removed from disk since
+    if expires_at <= time.monotonic():
+        del _url_cache[url]
+        return None
+    _url_cache.move_to_end(url)
+    if meta["source"] == "local":
+        return {**meta, "url": _local_download_url(DOWNLOAD_DIR / location)}
+    return {**meta, "url": _b2_object_url(location)}
+
+def _url_cache_put(url: str, meta: Dict[str, Any], location: str) -> None:
+    _url_cache[url] = (meta, location, time.monotonic() + _URL_CACHE_TTL)
+    _url_cache.move_to_end(url)
+    while len(_url_cache) > URL_CACHE_SIZE:
+        _url_cache.popitem(last=False)
 
 @app.post("/api/download-and-upload")
 async def download_and_upload(payload: Dict[str, Any]):
     url = (payload or {}).get("url")
     if not url:
         raise HTTPException(status_code=400, detail="Missing 'url'.")
+    return await _download_cached(_normalize_url(url))
 
-    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+@app.post("/api/batch")
+async def batch(payload: Dict[str, Any]):
+    urls = (payload or {}).get("urls")
+    if not isinstance(urls, list) or not urls:
+        raise HTTPException(status_code=400, detail="Missing 'urls' (non-empty list).")
+    if len(urls) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_URLS} URLs per batch.")
 
+    # Pipelines overlap on the shared threadpool; the semaphore keeps one
+    # batch from taking every yt-dlp instance and worker thread
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def _one(url: Any) -> Dict[str, Any]:
+        try:
+            async with sem:
+                result = await _download_cached(_normalize_url(url))
+            return {"url": url, "ok": True, "result": result}
+        except HTTPException as e:
+            return {"url": url, "ok": False, "status_code": e.status_code, "error": e.detail}
+        except Exception as e:
+            return {"url": url, "ok": False, "status_code": 500, "error": str(e)}
+
+    results: List[Dict[str, Any]] = await asyncio.gather(*(_one(u) for u in urls))
+    return {"results": results}
+
+async def _download_cached(url: str) -> Dict[str, Any]:
+    """Serve url from the result cache, or join/start its download pipeline."""
+    cached = _url_cache_get(url)
+    if cached:
+        return cached
+
+    # Coalesce concurrent requests for the same URL onto one download. Shielded
+    # so a client disconnecting doesn't cancel work other callers wait on.
+    task = _inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_process(url))
+        _inflight[url] = task
+        task.add_done_callback(lambda _: _inflight.pop(url, None))
+    return await asyncio.shield(task)
+
+async def _process(url: str) -> Dict[str, Any]:
+    """Download url with yt-dlp, upload to B2 if enabled, and build the response."""
+    # Per-request staging name: requests for the same video under different URL
+    # strings aren't coalesced, so they must never share (or unlink) one file
+    token = uuid.uuid4().hex
+    served: Optional[Path] = None
     try:
-        with YoutubeDL(_ydl_opts()) as ydl:
-            info = ydl.extract_info(url, download=True)
-    except Exception as e:
-        msg = str(e)
-        # Friendly hint for common YouTube bot check
-        if "confirm you’re not a bot" in msg.lower() or "confirm you're not a bot" in msg.lower():
-            raise HTTPException(
-                status_code=401,
-                detail=(
-                    "YouTube is requiring cookies. Set COOKIES_FROM_BROWSER "
-                    "or COOKIES_FILE in .env and restart the server."
-                ),
-            )
-        raise HTTPException(status_code=500, detail=f"yt-dlp error: {msg}")
-
-    out_path = _extract_output_path(info)
-    if not out_path or not out_path.exists():
-        raise HTTPException(status_code=500, detail="Download succeeded but file path was not found.")
-
-    # Try upload (if enabled); fall back to local URL if upload fails
-    try:
-        final_url = _maybe_upload(out_path)
-    except Exception as e:
-        if out_path.exists():
-            final_url = _local_download_url(out_path)
-        else:
-            raise HTTPException(status_code=500, detail=f"B2 upload failed: {e}")
-
-    return JSONResponse(
-        {
-            "source": "b2" if B2_ENABLED else "local",
-            "url": final_url,
-            "filename": out_path.name,
-            "size_bytes": out_path.stat().st_size if out_path.exists() else None,
+        try:
+            info = await _extract(url, str(DOWNLOAD_DIR / f"{token}-{_OUTTMPL_NAME}"))
+        except Exception as e:
+            msg = str(e)
+            # Friendly hint for common YouTube bot check
+            if _BOT_RE.search(msg):
+                raise HTTPException(
+                    status_code=401,
+                    detail=(
+                        "YouTube is requiring cookies. Set COOKIES_FROM_BROWSER "
+                        "or COOKIES_FILE in .env and restart the server."
+                    ),
+                )
+            raise HTTPException(status_code=500, detail=f"yt-dlp error: {msg}")
+
+        out_path = _extract_output_path(info)
+        if not out_path or not out_path.exists():
+            raise HTTPException(status_code=500, detail="Download succeeded but file path was not found.")
+
+        size_bytes = out_path.stat().st_size
+
+        # Try upload (if enabled); fall back to local URL if upload fails
+        object_key = None
+        try:
+            object_key = await run_in_threadpool(_maybe_upload, out_path)
+        except Exception as e:
+            if not out_path.exists():
+                raise HTTPException(status_code=500, detail=f"B2 upload failed: {e}")
+
+        meta = {
+            "source": "b2" if object_key else "local",
+            "filename": out_path.name[len(token) + 1:],
+            "size_bytes": size_bytes,
             "title": info.get("title"),
             "duration": info.get("duration"),
             "id": info.get("id"),
         }
-    )
+        if object_key:
+            _url_cache_put(url, meta, object_key)
+            return {**meta, "url": _b2_object_url(object_key)}
+
+        served = out_path
+        if not B2_ENABLED:
+            # A failed upload isn't cached, so the next request retries B2
+            _url_cache_put(url, meta, out_path.name)
+        return {**meta, "url": _local_download_url(out_path)}
+    finally:
+        # Drop everything this request staged (.part/.fNNN/.temp leftovers of a
+        # failed download, the uploaded copy) except a file served locally
+        for f in DOWNLOAD_DIR.glob(f"{token}-*"):
+            if f != served:
+                f.unlink(missing_ok=True)
 
 # Optional: quick healthcheck to verify B2 creds without a real download
 @app.post("/debug/b2")
@@ -210,14 +563,9 @@ async def debug_b2():
     try:
         _b2().put_object(Bucket=B2_BUCKET_NAME, Key=test_key, Body=body)
         if B2_PUBLIC_READ:
-            base = B2_PUBLIC_BASE_URL or f"{B2_S3_ENDPOINT}/{B2_BUCKET_NAME}"
-            url = f"{base}/{test_key}"
+            url = f"{B2_PUBLIC_BASE}/{test_key}"
         else:
-            url = _b2().generate_presigned_url(
-                "get_object",
-                Params={"Bucket": B2_BUCKET_NAME, "Key": test_key},
-                ExpiresIn=min(B2_PRESIGNED_TTL, 300),
-            )
+            url = _b2_presigned_url(test_key, min(B2_PRESIGNED_TTL, 300))
         return {"enabled": True, "bucket": B2_BUCKET_NAME, "url": url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"B2 healthcheck failed: {e}")
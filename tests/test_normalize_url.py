@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("DOWNLOAD_DIR", tempfile.mkdtemp(prefix="anygrab-test-"))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+from main import _normalize_url  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        # Extra "@" in userinfo: clients split on the last one
+        "http://a@b@169.254.169.254/latest/meta-data/",
+        "http://a@b@127.0.0.1/",
+        "http://x@localhost@localhost/",
+        # Other spellings of loopback/private/link-local literals
+        "http://127.1/",
+        "http://2130706433/",
+        "http://0x7f000001/",
+        "http://localhost./",
+        "http://a.localhost/",
+        "http://[::1]/",
+        "http://[::ffff:127.0.0.1]/",
+        "http://10.1.2.3/",
+        "http://192.168.0.1/",
+        "http://0/",
+    ],
+)
+def test_rejects_local_and_private_hosts(url):
+    with pytest.raises(HTTPException) as exc:
+        _normalize_url(url)
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.parametrize("url", ["ftp://example.com/x", "https://a b", "not a url", 5, None])
+def test_rejects_malformed_urls(url):
+    with pytest.raises(HTTPException) as exc:
+        _normalize_url(url)
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+        "https://user@vimeo.com:443/123#t=1",
+        "https://8.8.8.8/",
+        "https://[2606:4700::1111]/",
+    ],
+)
+def test_accepts_public_urls(url):
+    assert _normalize_url(f"  {url}  ") == url